@@ -0,0 +1,245 @@
+"""
+Numba kernels backing `Metrics`. Each kernel takes the step timestamps of a single
+step group and returns a single value, or NaN when there are too few steps.
+They use numpy's error model, so dividing by zero gives inf/NaN like numpy does rather than raising.
+`compute_all` runs every kernel over a batch of step groups stored CSR-style:
+group `i` is `ts_concat[offsets[i]:offsets[i+1]]`.
+"""
+import numpy as np
+from numba import njit
+
+
+# Phases (in cycles) this close to a whole cycle are treated as exactly on it
+PHASE_TOLERANCE = 1e-9
+
+
+@njit(cache=True, error_model='numpy')
+def side_stride_times(timestamps: np.ndarray):
+    """Stride times of each foot, assuming steps alternate feet"""
+    a = timestamps[2::2] - timestamps[:-2:2]
+    b = timestamps[3::2] - timestamps[1:-2:2]
+    return a, b
+
+
+@njit(cache=True, error_model='numpy')
+def var_coef(dist: np.ndarray) -> float:
+    """General formula for coefficient of variation"""
+    if len(dist) < 3:
+        return np.nan
+    return np.std(dist) / np.mean(dist)
+
+
+@njit(cache=True, error_model='numpy')
+def stga(timestamps: np.ndarray, min_steps: int) -> float:
+    if len(timestamps) < min_steps:
+        return np.nan
+    stride_times = timestamps[1:] - timestamps[:-1]
+    # TODO: Does this match literature?
+    # https://citeseerx.ist.psu.edu/document?repid=rep1&type=pdf&doi=aeee9316f2a72d0f89e59f3c5144bf69a695730b
+    return np.abs(np.mean(stride_times[1:] / stride_times[:-1]) - 1) / np.mean(stride_times)
+
+
+@njit(cache=True, error_model='numpy')
+def cadence(timestamps: np.ndarray, min_steps: int) -> float:
+    if len(timestamps) < min_steps:
+        return np.nan
+    return 1 / np.mean(timestamps[1:] - timestamps[:-1])
+
+
+@njit(cache=True, error_model='numpy')
+def stride_time(timestamps: np.ndarray, min_steps: int) -> float:
+    if len(timestamps) < min_steps:
+        return np.nan
+    a, b = side_stride_times(timestamps)
+    return (np.sum(a) + np.sum(b)) / (len(a) + len(b))
+
+
+@njit(cache=True, error_model='numpy')
+def stride_time_cv(timestamps: np.ndarray, min_steps: int) -> float:
+    if len(timestamps) < min_steps:
+        return np.nan
+    a, b = side_stride_times(timestamps)
+    return var_coef(np.concatenate((a, b)))
+
+
+@njit(cache=True, error_model='numpy')
+def hist_bins(values: np.ndarray, num_bins: int, lo: float, hi: float) -> np.ndarray:
+    if num_bins > len(values):
+        num_bins = len(values) - 1
+    return np.linspace(min(values.min(), lo), max(values.max(), hi), num_bins)
+
+
+@njit(cache=True, error_model='numpy')
+def bin_index(bins: np.ndarray, value: float) -> int:
+    """
+    Index of the bin containing `value`, for evenly spaced `bins`. Uses the same arithmetic
+    and edge corrections as `np.histogram`, so the last bin includes its right edge.
+    """
+    last = len(bins) - 2
+    i = min(int((value - bins[0]) * ((last + 1) / (bins[-1] - bins[0]))), last)
+    if value < bins[i]:
+        i -= 1
+    elif i != last and value >= bins[i + 1]:
+        i += 1
+    return i
+
+
+@njit(cache=True, error_model='numpy')
+def entropy(counts: np.ndarray, total: int) -> float:
+    """Shannon entropy (base 2) of a histogram with `total` samples"""
+    h = 0.0
+    scale = 1.0 / total
+    for count in counts:
+        if count:
+            p = count * scale
+            h -= p * np.log2(p)
+    return h
+
+
+@njit(cache=True, error_model='numpy')
+def shannon_entropy(values: np.ndarray, num_bins: int, lo=-np.pi, hi=np.pi) -> float:
+    if len(values) <= 1:
+        raise ValueError('Stride times must have at least 2 elements.')
+    bins = hist_bins(values, num_bins, lo, hi)
+    counts = np.zeros(len(bins) - 1, dtype=np.int64)
+    for value in values:
+        counts[bin_index(bins, value)] += 1
+    return entropy(counts, len(values))
+
+
+@njit(cache=True, error_model='numpy')
+def cond_entropy(S1: np.ndarray, S2: np.ndarray, num_bins: int, lo=0.0, hi=3.0) -> float:
+    """
+    Calculate the conditional entropy H(S1|S2) given two 1D numpy arrays S1 and S2.
+    """
+    bins = hist_bins(np.concatenate((S1, S2)), num_bins, lo, hi)
+    # Joint distribution of S1 and S2, and the marginal distribution of S2
+    joint = np.zeros((len(bins) - 1, len(bins) - 1), dtype=np.int64)
+    marginal = np.zeros(len(bins) - 1, dtype=np.int64)
+    for i in range(len(S1)):
+        j = bin_index(bins, S2[i])
+        joint[bin_index(bins, S1[i]), j] += 1
+        marginal[j] += 1
+    H_S1_S2 = entropy(joint.ravel(), len(S1)) # H(S1, S2)
+    H_S2 = entropy(marginal, len(S1)) # H(S2)
+    return H_S1_S2 - H_S2 # H(S1 | S2)
+
+
+@njit(cache=True, error_model='numpy')
+def phase(x: np.ndarray) -> np.ndarray:
+    """
+    Unwrapped instantaneous phase of `x` in cycles, modulo 1. Same as
+    `(np.unwrap(np.angle(scipy.signal.hilbert(x))) / (2 * np.pi)) % 1`, but fused into one pass,
+    and with phases within `PHASE_TOLERANCE` of a whole cycle snapped to it before wrapping.
+    """
+    n = len(x)
+    num_freqs = n // 2 + 1
+    cos = np.cos(2 * np.pi * np.arange(n) / n)
+    sin = np.sin(2 * np.pi * np.arange(n) / n)
+    # Real input DFT. Only the positive frequencies are needed for the analytic signal, and for
+    # stride time series this short a direct DFT beats FFT planning overhead.
+    re = np.zeros(num_freqs)
+    im = np.zeros(num_freqs)
+    for k in range(num_freqs):
+        for t in range(n):
+            j = k * t % n
+            re[k] += x[t] * cos[j]
+            im[k] -= x[t] * sin[j]
+        # Positive frequencies are doubled, DC and Nyquist are kept, negative frequencies are zeroed
+        if k != 0 and 2 * k != n:
+            re[k] *= 2
+            im[k] *= 2
+    # Inverse DFT, skipping the 1/n scale since it doesn't change the angle
+    out = np.empty(n)
+    prev_angle = 0.0
+    correction = 0.0
+    for t in range(n):
+        z_re = 0.0
+        z_im = 0.0
+        for k in range(num_freqs):
+            j = k * t % n
+            z_re += re[k] * cos[j] - im[k] * sin[j]
+            z_im += re[k] * sin[j] + im[k] * cos[j]
+        angle = np.arctan2(z_im, z_re)
+        if t > 0:
+            # Same unwrapping rule as np.unwrap
+            delta = angle - prev_angle
+            delta_mod = (delta + np.pi) % (2 * np.pi) - np.pi
+            if delta_mod == -np.pi and delta > 0:
+                delta_mod = np.pi
+            if abs(delta) >= np.pi:
+                correction += delta_mod - delta
+        prev_angle = angle
+        cycles = (angle + correction) / (2 * np.pi)
+        # Rounding noise around a whole cycle would otherwise wrap to either ~0 or ~1, landing in opposite
+        # histogram bins depending on how the DFT happened to round, so snap it to the whole cycle
+        if abs(cycles - np.round(cycles)) < PHASE_TOLERANCE:
+            cycles = np.round(cycles)
+        out[t] = cycles % 1
+    return out
+
+
+@njit(cache=True, error_model='numpy')
+def phase_sync(timestamps: np.ndarray, min_steps: int, num_bins=8) -> float:
+    if len(timestamps) < min_steps:
+        return np.nan
+    timestamps = timestamps[:len(timestamps) - len(timestamps) % 2]
+    left_stride_times, right_stride_times = side_stride_times(timestamps)
+    phase_difference = phase(left_stride_times) - phase(right_stride_times)
+    # Likewise, equal phases can differ by rounding noise, and 0 is a bin edge for short groups
+    phase_difference[np.abs(phase_difference) < PHASE_TOLERANCE] = 0.0
+    H = shannon_entropy(phase_difference, num_bins)
+    H_max = np.log2(num_bins)
+    return (H_max - H) / H_max
+
+
+# https://ieeexplore.ieee.org/stamp/stamp.jsp?tp=&arnumber=7247739
+@njit(cache=True, error_model='numpy')
+def conditional_entropy(timestamps: np.ndarray, min_steps: int, num_bins=8) -> float:
+    if len(timestamps) < min_steps:
+        return np.nan
+    timestamps = timestamps[:len(timestamps) - len(timestamps) % 2]
+    left_stride_times, right_stride_times = side_stride_times(timestamps)
+    left_cond_entropy = cond_entropy(left_stride_times, right_stride_times, num_bins)
+    right_cond_entropy = cond_entropy(right_stride_times, left_stride_times, num_bins)
+    return (left_cond_entropy + right_cond_entropy) / 2
+
+
+# Not `parallel=True`: this is called from threaded request handlers, which some numba threading
+# layers don't allow, and a request only has a few dozen short groups to spread over threads anyway
+@njit(cache=True, error_model='numpy')
+def compute_all(offsets: np.ndarray, ts_concat: np.ndarray, min_steps: np.ndarray) -> np.ndarray:
+    """
+    Computes every metric for each step group. Columns follow `Metrics.get_keys()`:
+    step_count, STGA, stride_time, cadence, var_coef, phase_sync, conditional_entropy.
+
+    Parameters
+    ----------
+    offsets : np.ndarray
+        Start index of each group in `ts_concat`, followed by `len(ts_concat)`
+    ts_concat : np.ndarray
+        Timestamps of all step groups, concatenated
+    min_steps : np.ndarray
+        Minimum number of steps required by each metric, in column order
+    """
+    num_groups = len(offsets) - 1
+    out = np.empty((num_groups, 7))
+    for i in range(num_groups):
+        timestamps = ts_concat[offsets[i]:offsets[i + 1]]
+        out[i, 0] = len(timestamps)
+        out[i, 1] = stga(timestamps, min_steps[1])
+        out[i, 2] = stride_time(timestamps, min_steps[2])
+        out[i, 3] = cadence(timestamps, min_steps[3])
+        out[i, 4] = stride_time_cv(timestamps, min_steps[4])
+        out[i, 5] = phase_sync(timestamps, min_steps[5])
+        out[i, 6] = conditional_entropy(timestamps, min_steps[6])
+    return out
+
+
+def warmup():
+    """
+    Compiles `compute_all` and every kernel it calls, or loads them from the on-disk cache,
+    so the first request doesn't pay the JIT cost. `min_steps` of 0 runs every kernel.
+    """
+    timestamps = np.cumsum(np.full(32, 0.55))
+    compute_all(np.array([0, len(timestamps)], dtype=np.int64), timestamps, np.zeros(7, dtype=np.int64))
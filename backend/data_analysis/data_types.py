@@ -1,7 +1,6 @@
 
 import numpy as np
-from copy import deepcopy
-from dataclasses import dataclass, field, asdict
+from dataclasses import dataclass, field
 from enum import Enum
 from pathlib import Path
 from plotly import graph_objects as go
@@ -18,12 +17,11 @@ class Event:
     duration: Optional[float] = None
     
     def to_dict(self):
-        data = deepcopy(self.__dict__)
-        if self.distance is None:
-            del data['distance']
-        if self.duration is None:
-            del data['duration']
-        data['timestamp'] = round(float(data['timestamp']), 5)
+        data = {'category': self.category, 'timestamp': round(float(self.timestamp), 5)}
+        if self.distance is not None:
+            data['distance'] = self.distance
+        if self.duration is not None:
+            data['duration'] = self.duration
         return data
 
 
@@ -41,13 +39,17 @@ class WalkPath:
         a, b, c = self.start, self.length, self.stop
         return 0.5 * np.sqrt(a + b + c) * np.sqrt(-a + b + c) * np.sqrt(a - b + c) * np.sqrt(a + b - c) / b
 
+    def to_dict(self):
+        return {'start': self.start, 'stop': self.stop, 'length': self.length}
+
 
 @dataclass
 class SensorEnvironment:
     fs: float
 
     def to_dict(self):
-        return asdict(self)
+        # Shallow, unlike `asdict` which deep copies every field
+        return {key: getattr(self, key) for key in self.__dataclass_fields__}
 
     @staticmethod
     def keys():
@@ -77,23 +79,30 @@ class RecordingEnvironment(SensorEnvironment):
         if self.footwear not in valid_footwear:
             raise ValueError(f'Invalid footwear "{self.footwear}". Valid footwear are: {valid_footwear}')
 
+    def to_dict(self):
+        data = super().to_dict()
+        if self.path is not None:
+            data['path'] = self.path.to_dict()
+        return data
+
 
 @dataclass
 class Recording:
     env: SensorEnvironment 
     events: list[Event] = field(default_factory=list)
-    ts: np.ndarray = field(default_factory=np.zeros(0))
+    ts: np.ndarray = field(default_factory=lambda: np.zeros(0))
     tag: Optional[str] = None
     sensor_type: Optional[str] = None
 
     def __post_init__(self):
-        self.ts = np.array(self.ts).squeeze()
+        self.ts = np.asarray(self.ts).squeeze()
         if len(self.ts) and self.ts.ndim != 1:
             raise ValueError(f'ts must be a 1D array, not {self.ts.ndim}D.')
 
     @classmethod
     def from_real_data(cls, fs: float, data: np.ndarray, tag=None):
-        return cls(SensorEnvironment(fs), events=[], ts=data, tag=tag)
+        # float32 is plenty for analyzing sensor readings, and halves the memory of every recording
+        return cls(SensorEnvironment(fs), events=[], ts=np.asarray(data, dtype=np.float32), tag=tag)
 
     @classmethod
     def from_file(cls, filename: str):
@@ -36,7 +36,7 @@ def generate_metrics(days: int, current_date: Optional[datetime]=None, asymmetry
     metrics.set_index(date_range[::-1])
     metrics._df = metrics._df[metrics._df['step_count'] > 2]
     for metric, max_val in hard_max.items():
-        metrics._df[metric][metrics._df[metric] > max_val] = np.nan
+        metrics._df = metrics._df.assign(**{metric: metrics._df[metric].mask(metrics._df[metric] > max_val)})
     return metrics
 
 
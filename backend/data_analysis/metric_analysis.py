@@ -208,7 +208,7 @@ class AnalysisController:
         recordings = []
         for data in datasets:
             recordings.append(data)
-            result = self.get_recording_metrics(data, plot_signals)
+            result = self.get_recording_steps(data, plot_signals)
             results.append(result)
         measured, truth, alg_err = self._parse_metric_results(results)
         err = measured.error(truth, absolute, normalize, count_both_nan)
@@ -246,7 +246,7 @@ class AnalysisController:
             if len(data.ts) < self._detector._window_duration * self.fs:
                 self.logger.warning(f"Recording {data.tag} is too short to analyze")
                 continue
-            result = self.get_recording_metrics(data, plot_signals)
+            result = self.get_recording_steps(data, plot_signals)
             results.append(result)
             if data.tag:
                 tags.append(data.tag)
@@ -259,14 +259,14 @@ class AnalysisController:
         self.logger.debug(f"Finished analyzing all {measured.recordings} datasets")
         return measured, source_of_truth, algorithm_error
 
-    def _parse_metric_results(self, results: Iterable[Tuple[Metrics, Metrics, pd.DataFrame]]) -> Tuple[Metrics, Metrics, pd.DataFrame]:
-        """Parses the results of a sequence of recording metrics"""
+    def _parse_metric_results(self, results: Iterable[Tuple[List[np.ndarray], List[np.ndarray], pd.DataFrame]]) -> Tuple[Metrics, Metrics, pd.DataFrame]:
+        """Computes the metrics of a sequence of recording step groups, all at once"""
         r = list(results)
         if not len(r):
             raise ValueError("No datasets provided")
-        measured_sets, source_of_truth_sets, algorithm_errors = zip(*r)
-        measured = sum(measured_sets)
-        source_of_truth = sum(source_of_truth_sets)
+        step_groups, true_step_groups, algorithm_errors = zip(*r)
+        measured = Metrics.from_recordings(step_groups)
+        source_of_truth = Metrics.from_recordings(true_step_groups)
         algorithm_error = pd.concat(algorithm_errors, ignore_index=True)
         return measured, source_of_truth, algorithm_error
 
@@ -305,18 +305,23 @@ class AnalysisController:
         varied_vars = {key: value for key, value in env_vars.items() if len(value) > 1}
         return varied_vars
     
-    def get_recording_metrics(self, data: Recording, plot=False, show=True):
+    def get_recording_metrics(self, data: Recording, plot=False, show=True) -> Tuple[Metrics, Metrics, pd.DataFrame]:
         """Analyzes a recording and returns metrics"""
+        step_groups, true_step_groups, algorithm_error = self.get_recording_steps(data, plot, show)
+        return Metrics(step_groups), Metrics(true_step_groups), algorithm_error
+
+    def get_recording_steps(self, data: Recording, plot=False, show=True) -> Tuple[List[np.ndarray], List[np.ndarray], pd.DataFrame]:
+        """Analyzes a recording and returns its measured step groups, true step groups and algorithm error"""
         if not isinstance(data, Recording):
             self.logger.warning(f"Data might not be of type recording: {type(data)}")
         try:
-            return self._get_recording_metrics(data, plot, show)
+            return self._get_recording_steps(data, plot, show)
         except Exception as e:
             self.logger.error(f"Failed to get metrics for {data.tag}: {e}")
             raise e
 
-    def _get_recording_metrics(self, data: Recording, plot=False, show=True) -> Tuple[Metrics, Metrics, pd.DataFrame]:
-        """Analyzes a recording and returns metrics"""
+    def _get_recording_steps(self, data: Recording, plot=False, show=True) -> Tuple[List[np.ndarray], List[np.ndarray], pd.DataFrame]:
+        """Analyzes a recording and returns its measured step groups, true step groups and algorithm error"""
         if data.env.fs != self.fs:
             raise ValueError(f"Recording fs ({data.env.fs}) does not match model fs ({self.fs})")
         true_step_groups = self._get_true_step_timestamps(data)
@@ -324,12 +329,12 @@ class AnalysisController:
         step_groups = self._detector.get_step_groups(data.ts, plot=plot, show=False, num_plots=4, specs=[[{'type': 'xy'}], [{'type': 'xy'}], [{'type': 'xy'}], [{'type': 'table'}]])
         if len(step_groups):
             self.logger.info(f"Found {len(step_groups)} step groups in {data.tag} ({len(true_steps)} true steps)")
-            self.logger.debug(f"Step groups: {step_groups}")
+            self.logger.debug("Step groups: %s", step_groups)
         predicted_steps = self.merge_step_groups(step_groups)
-        measured = Metrics(step_groups)
-        source_of_truth = Metrics(true_step_groups)
         algorithm_error = self._get_algorithm_error(predicted_steps, true_steps)
         if plot:
+            measured = Metrics(step_groups)
+            source_of_truth = Metrics(true_step_groups)
             fig = self._detector.fig
             fig.update_layout(title=data.tag)
             for true_groups in self._get_true_step_timestamps(data, ignore_quality=True):
@@ -355,7 +360,7 @@ class AnalysisController:
             self.fig = fig
             if show:
                 fig.show()
-        return measured, source_of_truth, algorithm_error
+        return step_groups, true_step_groups, algorithm_error
 
     def _get_true_step_timestamps(self, data: Recording, ignore_quality=False, max_step_delta=2) -> List[np.ndarray]:
         """Returns the true step timestamps of a recording, enforcing a maximum step delta if the recording quality is not normal"""
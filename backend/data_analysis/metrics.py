@@ -2,10 +2,10 @@ import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
-from scipy.signal import hilbert
-from scipy.stats import entropy
 from typing import List
 
+from _metrics_numba import compute_all
+
 
 class Metrics:
     """
@@ -31,6 +31,7 @@ class Metrics:
         'phase_sync': 8,
         'conditional_entropy': 6,
     }
+    _min_steps = np.array(list(STEP_REQUIREMENTS.values()), dtype=np.int64)
 
     stats = pd.DataFrame.from_dict({
             'STGA': [0.105,0.050,0.1,0.2,0.15], # TODO: FAKE NUMBERS
@@ -44,28 +45,46 @@ class Metrics:
         orient='index',
     )
 
-    def __init__(self, timestamp_groups: List[np.ndarray], recording_id=0):
-        func_map = self.get_func_map()
+    def __init__(self, timestamp_groups: List[np.ndarray], recording_id: 'int | np.ndarray' = 0):
         self.keys = self.get_keys()
         if len(timestamp_groups) == 0:
-            self._df = pd.DataFrame({key: [np.nan] for key in self.keys})
-            self._df['step_count'] = [0]
-        else:
-            data = {key: [func_map[key](timestamps) for timestamps in timestamp_groups] for key in self.keys}
-            self._df = pd.DataFrame.from_dict(data)
-        self._df['recording_id'] = [recording_id] * len(self._df)
+            timestamp_groups = [np.empty(0)]
+        lengths = np.fromiter(map(len, timestamp_groups), dtype=np.int64, count=len(timestamp_groups))
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        ts_concat = np.concatenate(timestamp_groups).astype(np.float64, copy=False)
+        data = compute_all(offsets, ts_concat, self._min_steps)
+        self._df = pd.DataFrame(data, columns=self.keys)
+        self._df['step_count'] = lengths
+        self._df['recording_id'] = recording_id
 
     @classmethod
-    def get_func_map(cls):
-        return {
-            'step_count': len,
-            'STGA': cls._get_STGA,
-            'stride_time': cls._get_stride_time,
-            'cadence': cls._get_cadence,
-            'var_coef': cls._get_stride_time_CV,
-            'phase_sync': cls._get_phase_sync,
-            'conditional_entropy': cls._get_conditional_entropy,
-        }
+    def from_recordings(cls, recordings: List[List[np.ndarray]]) -> 'Metrics':
+        """
+        Computes the metrics of several recordings, given the step groups of each, in a single batch.
+        Equivalent to `sum(Metrics(timestamp_groups) for timestamp_groups in recordings)`.
+        """
+        if len(recordings) == 0:
+            raise ValueError('No recordings provided.')
+        # Recordings without any steps still get a row, like Metrics([]) does
+        recordings = [timestamp_groups if len(timestamp_groups) else [np.empty(0)] for timestamp_groups in recordings]
+        timestamp_groups = [timestamps for timestamp_groups in recordings for timestamps in timestamp_groups]
+        group_counts = np.fromiter(map(len, recordings), dtype=np.int64, count=len(recordings))
+        recording_ids = np.repeat(np.arange(len(recordings)), group_counts)
+        return cls(timestamp_groups, recording_id=recording_ids)
+
+    @property
+    def _df(self) -> pd.DataFrame:
+        # Don't modify the returned frame in place, as that would leave by_tag() stale. Assign a new frame instead.
+        # Frames added together are only concatenated once they're read, so summing many Metrics is linear
+        if len(self._frames) > 1:
+            self._frames = [pd.concat(self._frames, ignore_index=True, sort=False)]
+        return self._frames[0]
+
+    @_df.setter
+    def _df(self, df: pd.DataFrame):
+        self._frames = [df]
+        self._aggregated = None # Cached result of aggregate(), rebuilt by by_tag() on first use
 
     @staticmethod
     def get_control() -> pd.Series:
@@ -95,122 +114,12 @@ class Metrics:
         return np.nansum(a*weights)/((~np.isnan(a))*weights).sum()
 
     def __len__(self):
-        return len(self._df)
+        return sum(len(frame) for frame in self._frames)
 
     @property
     def recordings(self):
         return self._df['recording_id'].nunique()
 
-    @staticmethod
-    def _get_STGA(timestamps: np.ndarray):
-        if len(timestamps) < Metrics.STEP_REQUIREMENTS['STGA']:
-            return np.nan
-        stride_times = np.diff(timestamps)
-        # TODO: Does this match literature?
-        # https://citeseerx.ist.psu.edu/document?repid=rep1&type=pdf&doi=aeee9316f2a72d0f89e59f3c5144bf69a695730b
-        return np.abs(np.mean(stride_times[1:] / stride_times[:-1]) - 1) / np.mean(stride_times)
-
-    @staticmethod
-    def _get_cadence(timestamps: np.ndarray):
-        if len(timestamps) < Metrics.STEP_REQUIREMENTS['cadence']:
-            return np.nan
-        return 1 / np.mean(np.diff(timestamps))
-
-    @staticmethod
-    def _get_stride_time(timestamps):
-        if len(timestamps) < Metrics.STEP_REQUIREMENTS['stride_time']:
-            return np.nan
-        return np.mean(Metrics._get_stride_times(timestamps))
-
-    @staticmethod
-    def _get_stride_time_CV(timestamps: np.ndarray):
-        if len(timestamps) < Metrics.STEP_REQUIREMENTS['var_coef']:
-            return np.nan
-        return Metrics._get_var_coef(Metrics._get_stride_times(timestamps))
-
-    @staticmethod
-    def _get_stride_times(timestamps: np.ndarray) -> np.ndarray:
-        if len(timestamps) < 2:
-            return np.empty((0))
-        a, b = Metrics._get_side_stride_times(timestamps)
-        stride_times = np.empty((a.size + b.size,), dtype=timestamps.dtype)
-        stride_times[0::2] = a
-        stride_times[1::2] = b
-        return stride_times
-
-    @staticmethod
-    def _get_side_stride_times(timestamps: np.ndarray) -> np.ndarray:
-        if len(timestamps) < 2:
-            return np.empty((0))
-        a = np.diff(timestamps[::2])
-        b = np.diff(timestamps[1::2])
-        return a, b  
-
-    @staticmethod
-    def _get_var_coef(dist):
-        """General formula for coefficient of variation"""
-        if len(dist) < 3:
-            return np.nan
-        return np.std(dist) / np.mean(dist)
-
-    @staticmethod
-    def _get_phase_sync(timestamps: np.ndarray, num_bins=8):
-        if len(timestamps) < Metrics.STEP_REQUIREMENTS['phase_sync']:
-            return np.nan
-        if len(timestamps) % 2 != 0:
-            timestamps = np.copy(timestamps)[:-1]
-        left_stride_times, right_stride_times = Metrics._get_side_stride_times(timestamps)
-        analytic_signal1 = hilbert(left_stride_times)
-        analytic_signal2 = hilbert(right_stride_times)
-        phase1 = (np.unwrap(np.angle(analytic_signal1)) / (2 * np.pi)) % 1
-        phase2 = (np.unwrap(np.angle(analytic_signal2)) / (2 * np.pi)) % 1
-        phase_difference = phase1 - phase2
-        H = Metrics._calculate_shannon_entropy(phase_difference, num_bins)
-        H_max = np.log2(num_bins)
-        return (H_max - H) / H_max
-
-    # https://ieeexplore.ieee.org/stamp/stamp.jsp?tp=&arnumber=7247739
-    @staticmethod
-    def _get_conditional_entropy(timestamps: np.ndarray, num_bins=8):
-        if len(timestamps) < Metrics.STEP_REQUIREMENTS['conditional_entropy']:
-            return np.nan
-        if len(timestamps) % 2 != 0:
-            timestamps = np.copy(timestamps)[:-1]
-        left_stride_times, right_stride_times = Metrics._get_side_stride_times(timestamps)
-        left_cond_entropy = Metrics._calculate_cond_entropy(left_stride_times, right_stride_times, num_bins)
-        right_cond_entropy = Metrics._calculate_cond_entropy(right_stride_times, left_stride_times, num_bins)
-        return (left_cond_entropy + right_cond_entropy) / 2
-
-    @staticmethod
-    def _calculate_shannon_entropy(values: np.ndarray, num_bins: int, bin_range=(-np.pi, np.pi)):
-        if len(values) <= 1:
-            raise ValueError('Stride times must have at least 2 elements.')
-        bins = Metrics._get_hist_bins(values, num_bins, bin_range)
-        counts, bins = np.histogram(values, bins=bins)
-        probabilities = counts / sum(counts)
-        return entropy(probabilities, base=2)
-
-    @staticmethod
-    def _calculate_cond_entropy(S1: np.ndarray, S2: np.ndarray, num_bins: int, bin_range=(0, 3)):
-        """
-        Calculate the conditional entropy H(S1|S2) given two 1D numpy arrays S1 and S2.
-        """
-        # Joint distribution of S1 and S2
-        bins = Metrics._get_hist_bins(np.concatenate([S1, S2]), num_bins, bin_range)
-        p_joint, _, _ = np.histogram2d(S1, S2, bins=bins, density=True)
-        p_S2 = np.sum(p_joint, axis=0) # Marginal distribution of S2
-        H_S1_S2 = entropy(p_joint.flatten(), base=2) # H(S1, S2)
-        H_S2 = entropy(p_S2, base=2) # H(S2)
-        H_S1_given_S2 = H_S1_S2 - H_S2 # H(S1 | S2)
-        return H_S1_given_S2
-
-    @staticmethod
-    def _get_hist_bins(values, num_bins: int, bin_range: tuple):
-        if num_bins > len(values):
-            num_bins = len(values) - 1
-        bin_range = (min(values.min(), bin_range[0]), max(values.max(), bin_range[1]))
-        return np.linspace(*bin_range, num_bins)
-
     def __add__(self, other: 'Metrics'):
         """Combines two Metrics objects by averaging their values."""
         if not isinstance(other, Metrics):
@@ -219,9 +128,12 @@ class Metrics:
             return other
         if not len(other):
             return self
-        last_recording_id = self._df['recording_id'].max()
-        other._df['recording_id'] += last_recording_id + 1
-        self._df = pd.concat([self._df, other._df], ignore_index=True, sort=False)
+        # Recording ids increase from frame to frame, so the last frame holds the largest
+        last_recording_id = self._frames[-1]['recording_id'].max()
+        # Shifted into a list first, since `other` may be `self`
+        shifted = [frame.assign(recording_id=frame['recording_id'] + last_recording_id + 1) for frame in other._frames]
+        self._frames.extend(shifted)
+        self._aggregated = None
         return self
 
     def __radd__(self, other: 'Metrics | int'):
@@ -254,30 +166,35 @@ class Metrics:
         return error
 
     def by_tag(self, smooth_window=0) -> pd.DataFrame:
-        df = self._df.groupby('recording_id').apply(self.aggregate)
+        if self._aggregated is None:
+            self._aggregated = self.aggregate(self._df)
         if smooth_window:
-            df = df.rolling(smooth_window, min_periods=1).mean()
-        return df
+            return self._aggregated.rolling(smooth_window, min_periods=1).mean()
+        return self._aggregated.copy() # Callers are free to modify the result
 
     def set_index(self, new_ids: list):
         old_ids = self._df['recording_id'].unique()
         if len(new_ids) != len(old_ids):
             raise ValueError(f'New IDs ({len(new_ids)}) must be the same length as old IDs ({len(old_ids)}).')
-        self._df['recording_id'].replace(dict(zip(old_ids, new_ids)), inplace=True)
+        self._df = self._df.assign(recording_id=self._df['recording_id'].map(dict(zip(old_ids, new_ids))))
 
     @staticmethod
-    def aggregate(data: pd.DataFrame):
+    def aggregate(data: pd.DataFrame) -> pd.DataFrame:
         """
-        Aggregates a group of metrics into a single row. All metrics are assumed to be
-        from the same recording. The `summed_vars` are summed, while all other metrics
-        are averaged, weighted by the step count.
+        Aggregates the metrics of each recording into a single row, grouped by recording_id.
+        The `summed_vars` are summed, while all other metrics are averaged, weighted by the
+        step count and ignoring NaNs.
         """
-        if len(data) == 0:
-            return pd.Series({key: np.nan for key in Metrics.get_keys()})
-        results = {}
-        for metric in Metrics.get_keys():
-            results[metric] = Metrics.aggregate_metric(data[metric], weights=data['step_count'])
-        return pd.Series(results)
+        keys = Metrics.get_keys()
+        averaged_vars = [key for key in keys if key not in Metrics.summed_vars]
+        recording_ids = data['recording_id']
+        weights = data['step_count']
+        values = data[averaged_vars]
+        # Weighted nanaverage, as two native grouped sums instead of a Python call per group
+        weighted_sums = values.mul(weights, axis=0).groupby(recording_ids).sum()
+        weight_sums = values.notna().mul(weights, axis=0).groupby(recording_ids).sum()
+        sums = data[list(Metrics.summed_vars)].groupby(recording_ids).sum(min_count=1)
+        return pd.concat([sums, weighted_sums / weight_sums], axis=1)[keys]
 
     def __str__(self) -> str:
         return str(self._df)
@@ -1,6 +1,9 @@
+import hmac
+import numpy as np
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import ForeignKey
-from sqlalchemy.orm import relationship
+from sqlalchemy import ForeignKey, func
+from sqlalchemy.orm import relationship, column_property
+from werkzeug.security import generate_password_hash, check_password_hash
 
 
 db = SQLAlchemy()
@@ -19,6 +22,8 @@ class Recordings(db.Model):
     sensorid = db.Column(db.Integer, ForeignKey('new_sensor.sensorid'))
     timestamp = db.Column(db.DateTime)
     ts_data = db.Column(db.ARRAY(db.Float))
+    # ts_data in postgres' binary array format. Much cheaper to fetch than a list of python floats, see decode_float_array
+    ts_bytes = column_property(func.array_send(ts_data), deferred=True)
     new_sensor = relationship('NewSensor', back_populates='recordings')
 
 # for sensor conflig
@@ -40,7 +45,46 @@ class FakeUser(db.Model):
     _id = db.Column("userid", db.Integer, primary_key=True)
     name = db.Column(db.String(255))
     email = db.Column(db.String(255))
-    password = db.Column(db.String(255))
+    password_hash = db.Column("password", db.String(255)) # werkzeug hash, or plaintext for legacy users
     usertype = db.Column(db.Integer, nullable=True) # 0 for OA, 1 for caregiver
     sensorid = db.Column(db.Integer, ForeignKey('new_sensor.sensorid'), nullable = True)
-    new_sensor = relationship('NewSensor', back_populates='users')
\ No newline at end of file
+    new_sensor = relationship('NewSensor', back_populates='users')
+
+    HASH_PREFIXES = ('scrypt:', 'pbkdf2:')
+
+    def set_password(self, password: str):
+        self.password_hash = generate_password_hash(password)
+
+    def check_password(self, password: str) -> bool:
+        """Checks `password` against the stored hash. Legacy plaintext passwords are rehashed once they match"""
+        if not self.password_hash or not isinstance(password, str):
+            return False
+        if self.password_hash.startswith(self.HASH_PREFIXES):
+            return check_password_hash(self.password_hash, password)
+        if not hmac.compare_digest(self.password_hash.encode(), password.encode()):
+            return False
+        self.set_password(password)
+        return True
+
+
+# Element of a float8[] in postgres' binary format: byte length, then the big-endian value
+FLOAT8_ARRAY_ELEMENT = np.dtype([('length', '>i4'), ('value', '>f8')])
+FLOAT8_OID = 701
+
+def decode_float_array(data: bytes) -> np.ndarray:
+    """
+    Decodes a 1D float8[] from postgres' binary array format (the output of `array_send`) into float32,
+    the precision recordings are analyzed at. The header is the number of dimensions, a has-nulls flag,
+    and the element type, followed by the size and lower bound of each dimension.
+    """
+    ndim, has_nulls, oid = (int.from_bytes(data[i:i + 4], 'big') for i in range(0, 12, 4))
+    if oid != FLOAT8_OID:
+        raise ValueError(f'Expected a float8[] (element type {FLOAT8_OID}), got element type {oid}')
+    if ndim == 0:
+        return np.empty(0, dtype=np.float32)
+    if ndim != 1 or has_nulls:
+        raise ValueError(f'Expected a 1D array without nulls, got {ndim}D (has_nulls={has_nulls})')
+    size = int.from_bytes(data[12:16], 'big')
+    if len(data) != 20 + size * FLOAT8_ARRAY_ELEMENT.itemsize:
+        raise ValueError(f'Array of {size} float8 values has the wrong length: {len(data)} bytes')
+    return np.frombuffer(data, dtype=FLOAT8_ARRAY_ELEMENT, offset=20)['value'].astype(np.float32)
@@ -1,45 +1,101 @@
 import os
 import sys
-import traceback
-from flask import jsonify, Blueprint, request, send_from_directory
+import zlib
+from itertools import chain
+from logging import getLogger, WARNING
+from flask import jsonify, Blueprint, Response, request, send_from_directory
+from flask_caching import Cache
 from http import HTTPStatus
+from sqlalchemy import func
 from sqlalchemy.exc import OperationalError
 import numpy as np
+import orjson
 from time import time
 
-from database import db, Recordings, NewSensor, FakeUser
+from database import db, Recordings, NewSensor, FakeUser, decode_float_array
 # This is hack, but it's the simplest way to get things to work without changing things - Daniel
 sys.path.append(os.path.join(os.path.dirname(__file__), 'data_analysis'))
 from data_analysis.metric_analysis import AnalysisController
 from data_analysis.data_types import Recording, get_optimal_analysis_params, SensorType
 from data_analysis.generate_dummies import generate_metrics, decay
+# Imported the same way `metrics` imports it, so it warms up the dispatchers `Metrics` actually uses
+from _metrics_numba import warmup as warmup_metrics
 
 
+logger = getLogger(__name__)
+# The analysis logs a few lines per recording at INFO, too many to write on every request
+analysis_logger = logger.getChild('analysis')
+analysis_logger.setLevel(WARNING)
+
 STATIC_FOLDER = "static"
 endpoints = Blueprint('endpoints', __name__, template_folder=STATIC_FOLDER)
+cache = Cache(config={'CACHE_TYPE': 'SimpleCache'})
+# Plot pages are large, so they get their own small cache and are stored compressed
+plot_cache = Cache(config={'CACHE_TYPE': 'SimpleCache', 'CACHE_THRESHOLD': 16})
+NOISE_AMP = 0.05
+METRICS_CACHE_TIMEOUT = 60 * 60 # seconds
+PLOT_CACHE_TIMEOUT = 24 * 60 * 60 # seconds
+
+
+def list_static_files(folder: str) -> frozenset:
+    """Paths of every file under `folder`, relative to it and '/' separated like request paths"""
+    root = os.path.join(os.path.dirname(__file__), folder)
+    return frozenset(
+        os.path.relpath(os.path.join(dirpath, filename), root).replace(os.sep, '/')
+        for dirpath, _, filenames in os.walk(root)
+        for filename in filenames
+    )
+
+
+# The frontend is built into the static folder before deployment, so it can be listed once at import
+STATIC_FILES = list_static_files(STATIC_FOLDER)
+
 # piezo_model = Recording.from_file('ctrl_model.yaml')
 
+
+def fast_jsonify(obj) -> Response:
+    """Like `jsonify`, but serializes numpy arrays natively and writes NaN as null"""
+    return Response(orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS), mimetype='application/json')
+
+
+def metrics_to_columns(df) -> dict:
+    """Column-wise dict of a `Metrics.by_tag` frame, in the shape the frontend expects"""
+    return {'recording_id': df.index.tolist(), **{column: df[column].to_numpy() for column in df.columns}}
+
+
 @endpoints.route('/api/list_recordings/<int:sensor_id>')
 def get_recording_ids(sensor_id: int):
     try:
-        recordings = db.session.query(Recordings).filter(Recordings.sensorid == sensor_id).all()
+        recordings = db.session.query(Recordings._id).filter(Recordings.sensorid == sensor_id).all()
         recording_ids = [recording._id for recording in recordings]
-        response = jsonify(recording_ids)
-        response.headers.add('Access-Control-Allow-Origin', '*')
-        return response
+        return fast_jsonify(recording_ids)
     except Exception as e:
         return jsonify(error=f"Error processing request: {str(e)}"), HTTPStatus.BAD_REQUEST
 
 
 @endpoints.route('/recording/<int:recording_id>')
 def plot_recording(recording_id: int):
-    recording = db.session.query(Recordings).filter(Recordings._id == recording_id).first()
-    sensor = db.session.query(NewSensor).filter(NewSensor._id == recording.sensorid).first()
-    rec = Recording.from_real_data(sensor.fs, recording.ts_data)
-    ctrl_params = get_optimal_analysis_params(SensorType.PIEZO, sensor.fs, version=-2, include_model=False)
-    analysis_controller = AnalysisController(fs=sensor.fs, noise_amp=0.05, **ctrl_params)
+    # Recordings never change once stored, so their plots can be cached by id alone
+    cache_key = f"plot_recording/{recording_id}/{NOISE_AMP}"
+    compressed_html = plot_cache.get(cache_key)
+    if compressed_html is not None:
+        return zlib.decompress(compressed_html).decode()
+    recording = (
+        db.session.query(Recordings.ts_bytes, NewSensor.fs)
+        .join(NewSensor, NewSensor._id == Recordings.sensorid)
+        .filter(Recordings._id == recording_id)
+        .first()
+    )
+    if recording is None:
+        return jsonify(error=f"Recording not found: {recording_id}"), HTTPStatus.NOT_FOUND
+    rec = Recording.from_real_data(recording.fs, decode_float_array(recording.ts_bytes))
+    ctrl_params = get_optimal_analysis_params(SensorType.PIEZO, recording.fs, version=-2, include_model=False)
+    analysis_controller = AnalysisController(fs=recording.fs, noise_amp=NOISE_AMP, logger=analysis_logger, **ctrl_params)
     analysis_controller.get_recording_metrics(rec, plot=True, show=False)
-    return analysis_controller.fig.to_html()
+    # Load plotly.js from its CDN rather than inlining all ~3.5 MB of it into every page
+    html = analysis_controller.fig.to_html(include_plotlyjs='cdn')
+    plot_cache.set(cache_key, zlib.compress(html.encode()), timeout=PLOT_CACHE_TIMEOUT)
+    return html
 
 
 @endpoints.route('/api/get_metrics/<email>')
@@ -50,47 +106,75 @@ def get_metrics(email: str, fake=True):
         cadence = np.concatenate([np.array([1.7] * plateau_length), decay(days - plateau_length, 1.7, 1.3)])
         metrics = generate_metrics(days=days, cadence=cadence, asymmetry=0.1, var=0.02, hard_max={'conditional_entropy': 0.2})
         df = metrics.by_tag(smooth_window=7)
-        df = df.replace(np.nan, None)
-        df.reset_index(inplace=True, drop=False)
-        print(df)
-        response = jsonify(df.to_dict('list'))
-        response.headers.add('Access-Control-Allow-Origin', '*')
-        return response
+        logger.debug("Fake metrics:\n%s", df)
+        return fast_jsonify(metrics_to_columns(df))
     try:
-        # fs from NewSensor
-        # ts_data, date, sensorid from recordings
-        user = db.session.query(FakeUser).filter(FakeUser.email == email).first()
-        if user is None:
-            return jsonify(error=f"User not found: {email}"), HTTPStatus.NOT_FOUND
-        #print(user)
-        db_userid = user._id
-        print("User ID:", db_userid)
-        sensor = db.session.query(NewSensor).filter(NewSensor.userid == db_userid).first()
-        print("Sample Rate:", sensor.fs)
-
-        recordings = db.session.query(Recordings).filter(Recordings.sensorid == sensor._id).all()
-        datasets = [Recording.from_real_data(sensor.fs, recording.ts_data, tag=recording.timestamp.strftime('%Y-%m-%d')) for recording in recordings]
-        print("Datasets:", len(datasets))
-        if len(datasets) == 0:
+        # Cheap summary of the user's recordings to key the cache on. It changes whenever a recording is added,
+        # so stale results are never served and there is nothing to invalidate explicitly.
+        num_recordings, latest_timestamp = (
+            db.session.query(func.count(Recordings._id), func.max(Recordings.timestamp))
+            .filter(Recordings.sensorid == user_sensor_id(email))
+            .one()
+        )
+        if num_recordings == 0:
             return jsonify(error=f"No recordings found for user: {email}"), HTTPStatus.NOT_FOUND
-        start_time = time() # for performance testing
-        ctrl_params = get_optimal_analysis_params(SensorType.PIEZO, sensor.fs, version=-2, include_model=False)
-        analysis_controller = AnalysisController(fs=sensor.fs, noise_amp=0.05, **ctrl_params)
-        metrics = analysis_controller.get_metrics(datasets)[0]
-        df = metrics.by_tag()
-        df = df.replace(np.nan, None)
-        df.reset_index(inplace=True, drop=False)
-        time_taken = time() - start_time
-        print(time_taken) # will print to server log for performance testing
-        print(df)
-        response = jsonify(df.to_dict('list'))
-        print(response)
-        response.headers.add('Access-Control-Allow-Origin', '*')
-        return response
+        cache_key = f"get_metrics/{email}/{num_recordings}/{latest_timestamp.isoformat()}/{NOISE_AMP}"
+        data = cache.get(cache_key)
+        if data is None:
+            data = compute_metrics(email)
+            cache.set(cache_key, data, timeout=METRICS_CACHE_TIMEOUT)
+        return fast_jsonify(data)
     except Exception as e:
-        traceback.print_exc()
+        logger.exception("Failed to get metrics for %s", email)
         return jsonify(error=f"Error processing request: {str(e)}"), HTTPStatus.BAD_REQUEST
 
+
+def user_sensor_id(email: str):
+    """
+    Subquery for the id of the user's sensor whose recordings are analyzed. Users may have several sensors,
+    but an AnalysisController only handles one sample rate, so only their first sensor is used.
+    """
+    return (
+        db.session.query(NewSensor._id)
+        .join(FakeUser, FakeUser._id == NewSensor.userid)
+        .filter(FakeUser.email == email)
+        .order_by(NewSensor._id)
+        .limit(1)
+        .scalar_subquery()
+    )
+
+
+def compute_metrics(email: str) -> dict:
+    """Runs the analysis on all of a user's recordings and returns the metrics of each day"""
+    # fs from NewSensor
+    # ts_data (as bytes), date from recordings
+    # Stream the recordings in batches so only a batch of raw ts_data is held in memory at a time,
+    # rather than every recording of the user
+    recordings = iter(
+        db.session.query(Recordings.ts_bytes, Recordings.timestamp, NewSensor.fs)
+        .join(NewSensor, NewSensor._id == Recordings.sensorid)
+        .filter(Recordings.sensorid == user_sensor_id(email))
+        .yield_per(100)
+    )
+    first = next(recordings, None)
+    if first is None:
+        raise ValueError(f"No recordings found for user: {email}")
+    fs = first.fs
+    datasets = (
+        Recording.from_real_data(recording.fs, decode_float_array(recording.ts_bytes), tag=recording.timestamp.strftime('%Y-%m-%d'))
+        for recording in chain([first], recordings)
+    )
+    logger.debug("Analyzing recordings sampled at %s Hz", fs)
+    start_time = time() # for performance testing
+    ctrl_params = get_optimal_analysis_params(SensorType.PIEZO, fs, version=-2, include_model=False)
+    analysis_controller = AnalysisController(fs=fs, noise_amp=NOISE_AMP, logger=analysis_logger, **ctrl_params)
+    metrics = analysis_controller.get_metrics(datasets)[0]
+    df = metrics.by_tag()
+    time_taken = time() - start_time
+    logger.info("Computed metrics for %s in %.3f s", email, time_taken) # for performance testing
+    logger.debug("Metrics:\n%s", df)
+    return metrics_to_columns(df)
+
 @endpoints.route('/api/get_user/', methods=['POST'])
 def get_user():
     try:
@@ -98,42 +182,28 @@ def get_user():
         email = data.get('email')
         password = data.get('password')
 
-        # get email and password from db
+        # get the user from db
         try:
-            creds = db.session.query(FakeUser).filter(FakeUser.email == email).first()
+            user = db.session.query(FakeUser).filter(FakeUser.email == email).first()
         except:
-            print("Creds didn't work")
+            logger.exception("Failed to query credentials")
             return jsonify({'message': 'Something broke when querying the FakeUser table!'}), HTTPStatus.INTERNAL_SERVER_ERROR
 
         # authenticate
-        if creds is None:
-            return jsonify({'message': 'Invalid credentials :('}), HTTPStatus.UNAUTHORIZED
-
-        elif email != creds.email: # email is not found
-            return jsonify({'message': 'Invalid email :('}), HTTPStatus.UNAUTHORIZED
-        
-        elif email == creds.email and password == creds.password: # email and password match
-            return jsonify({'message': 'Logged in successfully'}), HTTPStatus.OK
-        
-        elif email == creds.email and password != creds.password: # email is found, but password doesn't match
-            return jsonify({'message': 'Invalid password'}), HTTPStatus.UNAUTHORIZED
-        
-        else: # shouldn't get here, but if they do they were probably unauthorized
+        if user is None or not user.check_password(password):
             return jsonify({'message': 'Invalid credentials :('}), HTTPStatus.UNAUTHORIZED
+        if db.session.is_modified(user): # legacy plaintext password was rehashed
+            db.session.commit()
+        return jsonify({'message': 'Logged in successfully'}), HTTPStatus.OK
 
     except OperationalError as e:
-        print("Operational Error :(")
+        logger.exception("Operational error while logging in")
         db.session.rollback()
-        error = e
-        #return jsonify({"error": str(e)}), HTTPStatus.BAD_REQUEST
+        return jsonify({"error": str(e)}), HTTPStatus.BAD_REQUEST
     except Exception as e:
-        print("Exception error :(")
+        logger.exception("Error while logging in")
         db.session.rollback()
-        error = e
-        #return jsonify({"error": str(e)}), HTTPStatus.BAD_REQUEST    
-    finally:
-        print("I'm closing!")
-        db.session.close()
+        return jsonify({"error": str(e)}), HTTPStatus.BAD_REQUEST
 
 
 @endpoints.route('/api/create_user', methods=['POST'])
@@ -144,37 +214,30 @@ def create_user():
         email = data.get('email')
         password = data.get('password')
         sensorid = data.get('sensorid')
-        print(sensorid)
 
         try: # make sure the sensorid is correct!
             db_user_id = db.session.query(NewSensor.userid).filter(NewSensor._id == sensorid).first()
             if db_user_id is None:
                 return jsonify({'message': 'Hmmm, are you sure that you have the right SensorId?'}), HTTPStatus.UNAUTHORIZED
         except:
-            print ("The query broke! Not ideal.")
+            logger.exception("Failed to query sensor %s", sensorid)
             return jsonify({'message': 'Something broke when querying the database!'}), HTTPStatus.INTERNAL_SERVER_ERROR
 
         userid = db_user_id[0]
 
         try: # make sure the email hasn't been used already
             db_email = db.session.query(FakeUser.email).filter(FakeUser.email == email).first()
-            if db_email is None:
-                print("Unique email found. User can proceed.")
-            else:
-                print("I found this email!")
-                print(db_email[0])
+            if db_email is not None:
                 return jsonify({'message': 'Hmmm, it seems you already have an account with that email!'}), HTTPStatus.UNAUTHORIZED
 
         except:
-            print("Something broke!")
+            logger.exception("Failed to query email")
             return jsonify({'message': 'Something broke when querying the FakeUser table!'}), HTTPStatus.INTERNAL_SERVER_ERROR
 
 
         try: #make sure sensorid hasn't been used before
             db_sensor= db.session.query(FakeUser.sensorid).filter(FakeUser.sensorid == sensorid).first()
-            if db_sensor is None:
-                print("SensorId is unique. User may proceed.")
-            else:
+            if db_sensor is not None:
                 return jsonify({'message': 'Hmmm, it seems you already have an account with that sensorid!'}), HTTPStatus.UNAUTHORIZED
         except:
             return jsonify({'message': 'Something broke when querying the FakeUser table!'}), HTTPStatus.INTERNAL_SERVER_ERROR
@@ -191,9 +254,9 @@ def create_user():
                     _id=userid, # based on sensorid
                     name=name,
                     email=email,
-                    password=password,
                     sensorid=sensorid, 
                 )
+                new_data.set_password(password)
 
                 db.session.add(new_data)
                 db.session.commit() # add to database
@@ -201,18 +264,15 @@ def create_user():
                 return jsonify({"message": "Data added successfully"}), HTTPStatus.CREATED
 
             except OperationalError as e:
-                print("Operational Error :(")
+                logger.exception("Operational error while creating user")
                 db.session.rollback()
                 error = e
                 return jsonify({"error": str(e)}), HTTPStatus.BAD_REQUEST
             except Exception as e:
-                print("Exception error :(")
+                logger.exception("Error while creating user")
                 db.session.rollback()
                 error = e
                 return jsonify({"error": str(e)}), HTTPStatus.BAD_REQUEST    
-            finally:
-                print("I'm closing!")
-                db.session.close()
     except:         
         return jsonify({"error": str(error)}), HTTPStatus.BAD_REQUEST
 
@@ -221,7 +281,7 @@ def create_user():
 def serve(path):
     if 'api' in path:
         return jsonify(message="Resource not found"), HTTPStatus.NOT_FOUND
-    elif path != "" and os.path.exists(STATIC_FOLDER + '/' + path):
+    elif path in STATIC_FILES:
         return send_from_directory(STATIC_FOLDER, path)
     else:
         return send_from_directory(STATIC_FOLDER, 'index.html')